@@ -1,46 +1,116 @@
+import asyncio
+import bisect
+import itertools
 import logging
 import os
-import json
-import whisper
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from fractions import Fraction
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional, Set, Literal, List, Union
-from threading import Lock
+from types import MappingProxyType
+from typing import Callable, Dict, Mapping, Optional, Set, Literal, List, Tuple, Union
 
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request, Form
+import av
+import ctranslate2
+import numpy as np
+import orjson
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+from faster_whisper.audio import decode_audio as pyav_decode_audio
+from faster_whisper.utils import download_model
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request, Form, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import APIKeyHeader
-from fastapi.responses import PlainTextResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 import uvicorn
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Настройка логирования. LOG_LEVEL общий с uvicorn: его trace соответствует DEBUG,
+# неизвестное значение - INFO
+app_log_level = os.getenv("LOG_LEVEL", "info").upper()
+app_log_level = logging.DEBUG if app_log_level == "TRACE" else logging.getLevelName(app_log_level)
+logging.basicConfig(level=app_log_level if isinstance(app_log_level, int) else logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Pydantic модель для параметров транскрибации
-class TranscribeParams(BaseModel):
-    language: Optional[str] = Field(None, description="Язык аудио (auto-detect по умолчанию)")
-    task: Optional[str] = Field("transcribe", description="transcribe или translate")
-    temperature: Optional[float] = Field(0.0, description="Температура для генерации (0.0-1.0)")
-    beam_size: Optional[int] = Field(None, description="Размер луча для поиска")
-    best_of: Optional[int] = Field(None, description="Количество кандидатов для выбора лучшего")
-    compression_ratio_threshold: Optional[float] = Field(None, description="Порог сжатия для фильтрации")
-    logprob_threshold: Optional[float] = Field(None, description="Порог логарифмической вероятности")
-    no_speech_threshold: Optional[float] = Field(None, description="Порог детекции отсутствия речи")
-    condition_on_previous_text: Optional[bool] = Field(True, description="Использовать предыдущий текст как контекст")
-    initial_prompt: Optional[str] = Field(None, description="Начальная подсказка для модели")
-    word_timestamps: Optional[bool] = Field(False, description="Временные метки слов")
-    prepend_punctuations: Optional[str] = Field(None, description="Знаки препинания для добавления в начало")
-    append_punctuations: Optional[str] = Field(None, description="Знаки препинания для добавления в конец")
-    clip_timestamps: Optional[List[float]] = Field(None, description="Временные метки для обрезки аудио")
-    hallucination_silence_threshold: Optional[float] = Field(None, description="Порог тишины для детекции галлюцинаций")
-    format: Optional[Literal["json", "simple", "text"]] = Field("json", description="Формат ответа")
+# Параметры транскрибации. Обычный dataclass вместо модели pydantic: FastAPI уже разобрал
+# и привел значения к типам как query-параметры, повторная валидация модели не нужна
+@dataclass(frozen=True, slots=True)
+class TranscribeParams:
+    language: Optional[str] = Query(None, description="Язык аудио (auto-detect по умолчанию)")
+    task: Optional[str] = Query("transcribe", description="transcribe или translate")
+    temperature: Optional[str] = Query("0.0", description="Температура для генерации (0.0-1.0) или список через запятую для fallback")
+    # Как в openai-whisper: по умолчанию жадное декодирование и один кандидат при сэмплировании
+    # (у faster-whisper без явных значений beam_size=5 и best_of=5)
+    beam_size: Optional[int] = Query(1, description="Размер луча для поиска")
+    best_of: Optional[int] = Query(1, description="Количество кандидатов для выбора лучшего")
+    compression_ratio_threshold: Optional[float] = Query(None, description="Порог сжатия для фильтрации")
+    logprob_threshold: Optional[float] = Query(None, description="Порог логарифмической вероятности")
+    no_speech_threshold: Optional[float] = Query(None, description="Порог детекции отсутствия речи")
+    condition_on_previous_text: Optional[bool] = Query(False, description="Использовать предыдущий текст как контекст")
+    initial_prompt: Optional[str] = Query(None, description="Начальная подсказка для модели")
+    word_timestamps: Optional[bool] = Query(False, description="Временные метки слов")
+    prepend_punctuations: Optional[str] = Query(None, description="Знаки препинания для добавления в начало")
+    append_punctuations: Optional[str] = Query(None, description="Знаки препинания для добавления в конец")
+    clip_timestamps: Optional[str] = Query(None, description="Временные метки начала и конца фрагментов через запятую")
+    hallucination_silence_threshold: Optional[float] = Query(None, description="Порог тишины для детекции галлюцинаций")
+    format: Optional[Literal["json", "simple", "text", "ndjson"]] = Query("json", description="Формат ответа")
+
+# Типы вычислений CTranslate2 в порядке предпочтения. На GPU с Tensor Cores (CC >= 7.0) -
+# INT8 веса с FP16/BF16 активациями или чистая половинная точность, на остальных GPU и CPU - INT8
+COMPUTE_TYPE_PREFERENCE = {
+    "cuda": ("int8_float16", "int8_bfloat16", "float16", "bfloat16", "int8", "float32"),
+    "cpu": ("int8", "float32"),
+}
+
+# Имена параметров API, которые отличаются в faster-whisper
+WHISPER_PARAM_ALIASES = {"logprob_threshold": "log_prob_threshold"}
 
 # Глобальные переменные для модели и ключей
-model = None
-api_keys: Set[str] = set()
-keys_lock = Lock()
+model: Optional[WhisperModel] = None
+model_name: Optional[str] = None
+# Ключи хранятся в неизменяемом frozenset: перезагрузка атомарно подменяет ссылку,
+# поэтому проверка ключа обходится без блокировок. Файл перечитывается при изменении mtime
+api_keys: frozenset = frozenset()
+keys_mtime: Optional[int] = None
+keys_checked_at = 0.0
+# Как часто проверять mtime файла ключей; SIGHUP перечитывает файл сразу
+KEYS_CHECK_INTERVAL = 1.0
 keys_file_path = os.getenv("KEYS_FILE", "keys.txt")
 
+# Параметры декодирования аудио
+SAMPLE_RATE = 16000
+# Пустое значение (docker compose передает AUDIO_SPEEDUP= без .env) - без ускорения
+AUDIO_SPEEDUP = float(os.getenv("AUDIO_SPEEDUP") or "1.0")
+# Диапазон фильтра atempo: значение вне его ломало бы каждый запрос, поэтому проверяется при запуске
+if not 0.5 <= AUDIO_SPEEDUP <= 100:
+    raise ValueError(f"AUDIO_SPEEDUP должен быть от 0.5 до 100, получено {AUDIO_SPEEDUP}")
+WAV_READ_FRAMES = 1 << 16
+# Порог RMS (амплитуда float32 от 0 до 1), ниже которого запись считается тишиной и не идет в модель
+SILENCE_RMS_THRESHOLD = float(os.getenv("SILENCE_RMS_THRESHOLD", "0"))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_MB", "512")) * 1024 * 1024
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() in ("1", "true", "yes")
+
+# Размер пачки фрагментов речи для BatchedInferencePipeline (1 - последовательный режим)
+BATCH_SIZE = max(1, int(os.getenv("BATCH_SIZE", "8")))
+
+# Очередь транскрибаций: до MAX_BATCH запросов выполняются на модели одновременно
+MAX_BATCH = max(1, int(os.getenv("MAX_BATCH", "2")))
+transcribe_queue: Optional[asyncio.PriorityQueue] = None
+# Границы корзин длительности в секундах. Приоритет - время постановки в очередь плюс
+# QUEUE_BUCKET_DELAY секунд на каждую корзину: короткие записи обгоняют длинные, но только
+# пришедшие не позже этой задержки, поэтому длинная запись не ждет бесконечно.
+# Счетчик разрывает ничьи
+QUEUE_DURATION_BUCKETS = (10, 30)
+QUEUE_BUCKET_DELAY = 30.0
+queue_counter = itertools.count()
+inference_executor: Optional[ThreadPoolExecutor] = None
+batch_worker_task: Optional[asyncio.Task] = None
+
 # Схема безопасности
 api_key_header = APIKeyHeader(name="X-API-Key")
 
@@ -48,58 +118,513 @@ app = FastAPI(title="Whisper ASR Service", version="1.0.0")
 
 def load_api_keys():
     """Загружает API ключи из файла"""
-    global api_keys
+    global api_keys, keys_mtime
     try:
         if os.path.exists(keys_file_path):
+            mtime = os.stat(keys_file_path).st_mtime_ns
             with open(keys_file_path, 'r') as f:
-                keys = [line.strip() for line in f.readlines() if line.strip()]
-                with keys_lock:
-                    api_keys = set(keys)
-                logger.info(f"Загружено {len(api_keys)} API ключей")
+                api_keys = frozenset(line.strip() for line in f if line.strip())
+            keys_mtime = mtime
+            logger.info("Загружено %d API ключей", len(api_keys))
         else:
-            logger.warning(f"Файл ключей {keys_file_path} не найден")
+            logger.warning("Файл ключей %s не найден", keys_file_path)
     except Exception as e:
-        logger.error(f"Ошибка загрузки ключей: {e}")
+        logger.error("Ошибка загрузки ключей: %s", e)
+
+def get_api_keys() -> frozenset:
+    """Возвращает API ключи, перечитывая файл только если он изменился"""
+    global keys_checked_at
+    now = time.monotonic()
+    if now - keys_checked_at < KEYS_CHECK_INTERVAL:
+        return api_keys
+    keys_checked_at = now
+
+    try:
+        mtime = os.stat(keys_file_path).st_mtime_ns
+    except OSError:
+        mtime = None
+
+    if mtime is not None and mtime != keys_mtime:
+        load_api_keys()
+    return api_keys
+
+def resolve_compute_type(device: str) -> str:
+    """Выбирает тип вычислений CTranslate2 для устройства"""
+    compute_type = os.getenv("WHISPER_COMPUTE")
+    if compute_type:
+        return compute_type
+
+    if device == "auto":
+        device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+
+    supported = ctranslate2.get_supported_compute_types(device)
+    for compute_type in COMPUTE_TYPE_PREFERENCE[device]:
+        if compute_type in supported:
+            return compute_type
+    return "default"
+
+def download_model_path(name: str, download_root: str) -> str:
+    """Возвращает путь к весам в MODEL_DOWNLOAD_ROOT, скачивая модель только при промахе"""
+    if os.path.isdir(name):
+        return name
+    # Уже скачанная модель берется из кэша без обращения к Hugging Face Hub
+    try:
+        return download_model(name, local_files_only=True, cache_dir=download_root)
+    except Exception:
+        logger.info("Модель %s не найдена в %s, скачивание", name, download_root)
+        return download_model(name, cache_dir=download_root)
+
+def resolve_model_path(name: str, download_root: str) -> str:
+    """Возвращает локальный путь к весам модели, при необходимости копируя их в MODEL_CACHE_DIR"""
+    cache_dir = os.getenv("MODEL_CACHE_DIR")
+    if not cache_dir:
+        return download_model_path(name, download_root)
+
+    # Копия на локальном быстром диске (NVMe/tmpfs) избавляет запуск от чтения весов с медленного тома.
+    # Если она уже есть, MODEL_DOWNLOAD_ROOT и Hugging Face Hub не нужны
+    cached_path = os.path.join(cache_dir, name.strip("/").replace("/", "--"))
+    if os.path.isdir(cached_path):
+        return cached_path
+
+    path = download_model_path(name, download_root)
+    logger.info("Копирование модели в %s", cached_path)
+    # Несколько воркеров могут копировать одновременно: у каждого свой временный каталог,
+    # а проигравший переименование использует копию победителя
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".model-")
+    try:
+        shutil.copytree(path, temp_path, dirs_exist_ok=True)
+        os.replace(temp_path, cached_path)
+    except OSError:
+        if not os.path.isdir(cached_path):
+            raise
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+    return cached_path
 
 def load_model():
     """Загружает модель Whisper"""
-    global model
-    model_name = os.getenv("DEFAULT_MODEL", "turbo")
+    global model, model_name
+    name = os.getenv("DEFAULT_MODEL", "turbo")
     download_root = os.getenv("MODEL_DOWNLOAD_ROOT", "./models")
-    device = os.getenv("MODEL_DEVICE", "cpu")
+    device = os.getenv("MODEL_DEVICE") or "auto"
+    # Ядра CPU делятся между параллельными воркерами CTranslate2
+    cpu_threads = int(os.getenv("CPU_THREADS", "0")) or max(1, (os.cpu_count() or 1) // MAX_BATCH)
+    # Несколько GPU: CTranslate2 держит копию модели на каждой и сам распределяет вызовы между ними
+    device_index = [int(index) for index in os.getenv("MODEL_DEVICE_INDEX", "0").split(",")]
+    flash_attention = os.getenv("FLASH_ATTENTION", "false").lower() in ("1", "true", "yes")
 
     try:
-        logger.info(f"Загрузка модели Whisper: {model_name}")
-        model = whisper.load_model(model_name, device=device, download_root=download_root)
+        compute_type = resolve_compute_type(device)
+        logger.info(
+            "Загрузка модели Whisper: %s (device=%s, device_index=%s, compute_type=%s, flash_attention=%s)",
+            name, device, device_index, compute_type, flash_attention
+        )
+        # num_workers задается на каждое устройство и позволяет CTranslate2 выполнять параллельные
+        # вызовы transcribe() из разных потоков; всего одновременно выполняется MAX_BATCH вызовов
+        model = WhisperModel(
+            resolve_model_path(name, download_root),
+            device=device,
+            device_index=device_index,
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            num_workers=-(-MAX_BATCH // len(device_index)),
+            download_root=download_root,
+            flash_attention=flash_attention
+        )
+        model_name = name
         logger.info("Модель успешно загружена")
     except Exception as e:
-        logger.error(f"Ошибка загрузки модели: {e}")
+        logger.error("Ошибка загрузки модели: %s", e)
         raise
 
+@lru_cache(maxsize=64)
+def parse_temperature(value: str) -> Union[float, Tuple[float, ...]]:
+    """Разбирает температуру или список температур для fallback"""
+    temperatures = tuple(float(item) for item in value.split(","))
+    return temperatures[0] if len(temperatures) == 1 else temperatures
+
+@lru_cache(maxsize=64)
+def parse_clip_timestamps(value: str) -> Tuple[float, ...]:
+    """Разбирает метки фрагментов и переводит их в шкалу ускоренного аудио"""
+    return tuple(float(item) / AUDIO_SPEEDUP for item in value.split(","))
+
+@lru_cache(maxsize=256)
+def build_whisper_params(params: TranscribeParams) -> MappingProxyType:
+    """Готовит параметры для WhisperModel.transcribe(); результат кэшируется по набору параметров"""
+    whisper_params = {}
+    for field in fields(params):
+        field_value = getattr(params, field.name)
+        if field_value is not None and field.name != "format":
+            whisper_params[WHISPER_PARAM_ALIASES.get(field.name, field.name)] = field_value
+
+    # Строковые списки разбираются в числа
+    if "temperature" in whisper_params:
+        whisper_params["temperature"] = parse_temperature(whisper_params["temperature"])
+    if "clip_timestamps" in whisper_params:
+        whisper_params["clip_timestamps"] = parse_clip_timestamps(whisper_params["clip_timestamps"])
+    # Словарь общий для всех запросов с теми же параметрами, поэтому только для чтения
+    return MappingProxyType(whisper_params)
+
+def restore_time(seconds: float) -> float:
+    """Пересчитывает метку времени ускоренного аудио в исходную шкалу"""
+    return round(seconds * AUDIO_SPEEDUP, 3)
+
+def segment_to_dict(segment) -> Dict:
+    """Преобразует сегмент faster-whisper в словарь в формате openai-whisper"""
+    result = {
+        # faster-whisper нумерует сегменты с 1, openai-whisper - с 0
+        "id": segment.id - 1,
+        "seek": segment.seek,
+        "start": restore_time(segment.start),
+        "end": restore_time(segment.end),
+        "text": segment.text,
+        "tokens": segment.tokens,
+        "temperature": segment.temperature,
+        "avg_logprob": segment.avg_logprob,
+        "compression_ratio": segment.compression_ratio,
+        "no_speech_prob": segment.no_speech_prob,
+    }
+    if segment.words is not None:
+        result["words"] = [
+            {
+                "word": word.word,
+                "start": restore_time(word.start),
+                "end": restore_time(word.end),
+                "probability": word.probability
+            }
+            for word in segment.words
+        ]
+    return result
+
+def build_result(segments: List, info) -> Dict:
+    """Собирает ответ в формате whisper.transcribe()"""
+    return {
+        "text": "".join(segment.text for segment in segments),
+        "segments": [segment_to_dict(segment) for segment in segments],
+        "language": info.language,
+    }
+
+def dump_json_line(content) -> bytes:
+    """Сериализует объект в строку NDJSON"""
+    return orjson.dumps(content, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+
+def json_response(content) -> Response:
+    """JSON ответ через orjson, минуя jsonable_encoder и стандартный json"""
+    return Response(content=orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY), media_type="application/json")
+
+def read_pcm_wav(file) -> Optional[np.ndarray]:
+    """Читает 16 кГц моно 16-bit PCM WAV без ffmpeg, для остальных файлов возвращает None"""
+    # Остальные контейнеры отсекаются по сигнатуре RIFF/WAVE, не запуская разбор заголовка
+    header = file.read(12)
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+
+    try:
+        with wave.open(file, "rb") as wav:
+            if wav.getframerate() != SAMPLE_RATE or wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+                return None
+            # Читаем блоками прямо в итоговый массив, не держа в памяти весь PCM как bytes.
+            # Размер в заголовке ограничен размером файла: при записи в pipe ffmpeg и arecord
+            # пишут туда 0xFFFFFFFF
+            audio = np.empty(min(wav.getnframes(), size // 2), dtype=np.float32)
+            length = 0
+            while frames := wav.readframes(WAV_READ_FRAMES):
+                # Файл, обрезанный посреди отсчета, заканчивается нечетным числом байт
+                samples = np.frombuffer(frames[:len(frames) // 2 * 2], dtype=np.int16)
+                audio[length:length + len(samples)] = samples
+                length += len(samples)
+    except (wave.Error, EOFError):
+        return None
+    finally:
+        file.seek(0)
+
+    audio = audio[:length]
+    audio *= 1 / 32768.0
+    return audio
+
+def read_audio(file) -> np.ndarray:
+    """Декодирует аудио в процессе: WAV напрямую, остальные форматы через PyAV (libavformat)"""
+    audio = read_pcm_wav(file)
+    if audio is not None:
+        return audio
+
+    try:
+        return pyav_decode_audio(file, sampling_rate=SAMPLE_RATE)
+    except av.error.FFmpegError as e:
+        raise HTTPException(status_code=400, detail=f"Не удалось декодировать аудио: {e.strerror}")
+    except IndexError:
+        raise HTTPException(status_code=400, detail="Не удалось декодировать аудио: в файле нет аудиодорожки")
+
+def speed_up_audio(audio: np.ndarray) -> np.ndarray:
+    """Ускоряет аудио фильтром atempo (libavfilter) без изменения высоты тона"""
+    graph = av.filter.Graph()
+    source = graph.add_abuffer(format="flt", sample_rate=SAMPLE_RATE, layout="mono", time_base=Fraction(1, SAMPLE_RATE))
+    atempo = graph.add("atempo", str(AUDIO_SPEEDUP))
+    sink = graph.add("abuffersink")
+    source.link_to(atempo)
+    atempo.link_to(sink)
+    graph.configure()
+
+    chunks = []
+
+    def drain():
+        while True:
+            try:
+                chunks.append(sink.pull().to_ndarray()[0])
+            except (av.error.BlockingIOError, av.error.EOFError):
+                return
+
+    # Подаем аудио кадрами по секунде, None в конце сбрасывает буфер фильтра
+    for offset in range(0, len(audio), SAMPLE_RATE):
+        frame = av.AudioFrame.from_ndarray(audio[offset:offset + SAMPLE_RATE].reshape(1, -1), format="flt", layout="mono")
+        frame.sample_rate = SAMPLE_RATE
+        frame.time_base = Fraction(1, SAMPLE_RATE)
+        frame.pts = offset
+        source.push(frame)
+        drain()
+    source.push(None)
+    drain()
+
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+def load_audio(file) -> np.ndarray:
+    """Декодирует загрузку и при необходимости ускоряет её"""
+    audio = read_audio(file)
+    if AUDIO_SPEEDUP != 1.0 and len(audio):
+        audio = speed_up_audio(audio)
+    return audio
+
+def is_silent(audio: np.ndarray) -> bool:
+    """Проверяет, что громкость записи ниже SILENCE_RMS_THRESHOLD"""
+    if not len(audio):
+        return True
+    return float(np.sqrt(np.dot(audio, audio) / len(audio))) < SILENCE_RMS_THRESHOLD
+
+async def decode_audio(audio_file: UploadFile) -> np.ndarray:
+    """Декодирует загрузку в 16 кГц моно float32"""
+    # Декодирование и atempo выполняются в процессе, без запуска ffmpeg
+    return await run_in_threadpool(load_audio, audio_file.file)
+
+def run_transcription(
+    audio: np.ndarray,
+    whisper_params: Mapping,
+    on_segment: Optional[Callable[[Dict], None]] = None
+) -> Optional[Dict]:
+    """Выполняет транскрибацию в потоке инференса"""
+    # Пачечный режим режет аудио по VAD и прогоняет фрагменты через модель пачками.
+    # clip_timestamps в нём имеют другой формат, а первый сегмент появляется только после
+    # декодирования целой пачки, поэтому такие запросы и потоковый ответ идут последовательно
+    if BATCH_SIZE > 1 and "clip_timestamps" not in whisper_params and on_segment is None:
+        # Пайплайн хранит состояние между пачками, поэтому создается на каждый запрос.
+        # Без меток времени (по умолчанию в пайплайне) сегмент - целый фрагмент VAD до 30 с,
+        # поэтому метки включаются явно, чтобы сегменты были по фразам, как в последовательном режиме
+        pipeline = BatchedInferencePipeline(model=model)
+        segments, info = pipeline.transcribe(
+            audio, batch_size=BATCH_SIZE, without_timestamps=False, **whisper_params
+        )
+    elif BATCH_SIZE > 1 and "clip_timestamps" not in whisper_params:
+        # Потоковый ответ в пачечном режиме: тот же фильтр VAD, что и у пайплайна,
+        # чтобы текст не зависел от формата ответа
+        segments, info = model.transcribe(audio, vad_filter=True, **whisper_params)
+    else:
+        segments, info = model.transcribe(audio, **whisper_params)
+
+    if on_segment is None:
+        return build_result(list(segments), info)
+
+    # Потоковый режим: сегменты отдаются по мере декодирования
+    for segment in segments:
+        on_segment(segment_to_dict(segment))
+    return None
+
+async def batch_worker():
+    """Забирает запросы из очереди, держа на модели до MAX_BATCH транскрибаций одновременно"""
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(MAX_BATCH)
+    running: Set[asyncio.Task] = set()
+
+    async def run_job(audio: np.ndarray, whisper_params: Mapping, on_segment: Optional[Callable], future: asyncio.Future):
+        try:
+            result = await loop.run_in_executor(
+                inference_executor, run_transcription, audio, whisper_params, on_segment
+            )
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            slots.release()
+
+    while True:
+        await slots.acquire()
+        _, _, (audio, whisper_params, on_segment, future) = await transcribe_queue.get()
+        if future.cancelled():
+            slots.release()
+            continue
+
+        # Новый запрос стартует, как только освобождается слот, не дожидаясь остальных
+        task = asyncio.create_task(run_job(audio, whisper_params, on_segment, future))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+async def submit_transcription(
+    audio: np.ndarray,
+    whisper_params: Mapping,
+    on_segment: Optional[Callable[[Dict], None]] = None
+) -> Optional[Dict]:
+    """Ставит транскрибацию в очередь и ожидает результат"""
+    future = asyncio.get_running_loop().create_future()
+    bucket = bisect.bisect(QUEUE_DURATION_BUCKETS, len(audio) / SAMPLE_RATE)
+    priority = time.monotonic() + bucket * QUEUE_BUCKET_DELAY
+    await transcribe_queue.put((priority, next(queue_counter), (audio, whisper_params, on_segment, future)))
+    return await future
+
+class StreamClosed(Exception):
+    """Клиент потокового ответа отключился, транскрибацию можно прервать"""
+
+async def stream_transcription(audio: np.ndarray, whisper_params: Mapping):
+    """Отдает сегменты в формате NDJSON по мере распознавания"""
+    loop = asyncio.get_running_loop()
+    segments: asyncio.Queue = asyncio.Queue()
+    closed = threading.Event()
+
+    def on_segment(segment: Dict):
+        # Исключение останавливает цикл по сегментам в потоке инференса и освобождает слот
+        if closed.is_set():
+            raise StreamClosed()
+        loop.call_soon_threadsafe(segments.put_nowait, segment)
+
+    # Завершение задачи приходит в цикл событий после всех сегментов, поэтому None - последний элемент
+    job = asyncio.ensure_future(submit_transcription(audio, whisper_params, on_segment))
+    job.add_done_callback(lambda _: segments.put_nowait(None))
+
+    try:
+        while (segment := await segments.get()) is not None:
+            yield dump_json_line(segment)
+
+        # Статус ответа уже отправлен, поэтому ошибка передается последней строкой
+        if job.exception():
+            logger.error("Ошибка транскрибации: %s", job.exception())
+            yield dump_json_line({"error": f"Ошибка транскрибации: {job.exception()}"})
+    finally:
+        # Клиент отключился: запрос еще в очереди снимается, а идущая транскрибация
+        # прерывается на следующем сегменте. Результат задачи забирается, чтобы asyncio
+        # не писал "Task exception was never retrieved"
+        if not job.done():
+            closed.set()
+            job.cancel()
+            job.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+def warmup_model():
+    """Прогоняет через модель секунду тишины, чтобы первый запрос не платил за ленивую инициализацию"""
+    logger.info("Прогрев модели")
+    segments, _ = model.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32))
+    list(segments)
+    logger.info("Модель прогрета")
+
 def verify_api_key(api_key: str = Depends(api_key_header)) -> str:
     """Проверяет API ключ"""
     if not api_key:
         raise HTTPException(status_code=401, detail="API ключ не предоставлен")
 
-    # Перезагружаем ключи для проверки обновлений
-    load_api_keys()
-
-    with keys_lock:
-        if api_key not in api_keys:
-            raise HTTPException(status_code=403, detail="Неверный API ключ")
+    if api_key not in get_api_keys():
+        raise HTTPException(status_code=403, detail="Неверный API ключ")
 
     return api_key
 
+def check_transcribe_request(request: Request):
+    """Проверяет ключ, модель и размер загрузки по заголовкам, до чтения тела запроса"""
+    verify_api_key(request.headers.get("X-API-Key"))
+
+    if model is None:
+        raise HTTPException(status_code=500, detail="Модель не загружена")
+
+    content_length = request.headers.get("content-length")
+    if MAX_UPLOAD_SIZE and content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE:
+        raise upload_too_large()
+
+def upload_too_large() -> HTTPException:
+    """Ошибка 413 для загрузки больше MAX_UPLOAD_MB"""
+    return HTTPException(status_code=413, detail=f"Файл больше {MAX_UPLOAD_SIZE // (1024 * 1024)} МБ")
+
+class RejectEarlyMiddleware:
+    """Отклоняет заведомо неуспешные транскрибации, не принимая загрузку"""
+    # FastAPI разбирает multipart-тело до вызова зависимостей, поэтому проверки вынесены в middleware.
+    # Это ASGI middleware, а не @app.middleware("http"): размер chunked-загрузки без Content-Length
+    # можно ограничить только подсчетом байт в receive
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != "/transcribe":
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            check_transcribe_request(Request(scope))
+        except HTTPException as e:
+            response = JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+            await response(scope, receive, send)
+            return
+
+        if not MAX_UPLOAD_SIZE:
+            await self.app(scope, receive, send)
+            return
+
+        received = 0
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                # Исключение прерывает разбор формы и превращается в ответ 413
+                if received > MAX_UPLOAD_SIZE:
+                    raise upload_too_large()
+            return message
+
+        await self.app(scope, receive_limited, send)
+
+app.add_middleware(RejectEarlyMiddleware)
+
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске"""
+    global transcribe_queue, inference_executor, batch_worker_task
     load_api_keys()
+    # systemctl reload (ExecReload в asr.service) перечитывает ключи, а не завершает процесс.
+    # При WEB_CONCURRENCY > 1 SIGHUP получает управляющий процесс uvicorn и перезапускает воркеры
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, load_api_keys)
+    except (NotImplementedError, AttributeError, RuntimeError):
+        pass
     load_model()
+    if MODEL_WARMUP:
+        await run_in_threadpool(warmup_model)
+
+    transcribe_queue = asyncio.PriorityQueue()
+    inference_executor = ThreadPoolExecutor(max_workers=MAX_BATCH, thread_name_prefix="whisper")
+    batch_worker_task = asyncio.create_task(batch_worker())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Останавливает обработчик очереди"""
+    if batch_worker_task:
+        batch_worker_task.cancel()
+    if inference_executor:
+        inference_executor.shutdown(wait=False)
 
 @app.get("/health")
 async def health_check():
     """Проверка здоровья сервиса"""
-    return {"status": "healthy", "model_loaded": model is not None, "current_model": str(model) if model else None}
+    return {"status": "healthy", "model_loaded": model is not None, "current_model": model_name if model else None}
 
 @app.post("/transcribe")
 async def transcribe_audio(
@@ -111,66 +636,75 @@ async def transcribe_audio(
     if model is None:
         raise HTTPException(status_code=500, detail="Модель не загружена")
 
-    # Готовим параметры для whisper.transcribe()
-    whisper_params = {}
-    for field_name, field_value in params.dict(exclude_none=True, exclude={'format'}).items():
-        whisper_params[field_name] = field_value
+    # Большинство запросов приходит с одинаковыми параметрами, они собираются один раз
+    try:
+        whisper_params = build_whisper_params(params)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Неверный список чисел: {e}")
 
     # Формат ответа
     response_format = params.format
 
-    temp_file_path = None
     try:
-        # Сохраняем временный файл
-        temp_file_path = f"/tmp/{audio_file.filename}"
-        with open(temp_file_path, "wb") as temp_file:
-            content = await audio_file.read()
-            temp_file.write(content)
+        # Декодируем аудио напрямую из загрузки, без временных файлов
+        audio = await decode_audio(audio_file)
 
         # Транскрибируем
-        logger.info(f"Транскрибация файла: {audio_file.filename} с параметрами: {whisper_params}")
-        result = model.transcribe(temp_file_path, **whisper_params)
+        # Длительность берется из декодированного буфера, в исходной шкале времени
+        logger.info("Транскрибация файла: %s (%.1f с)", audio_file.filename, restore_time(len(audio) / SAMPLE_RATE))
+        logger.debug("Параметры транскрибации: %s", whisper_params)
 
-        # Удаляем временный файл
-        os.unlink(temp_file_path)
+        # Тишина отсекается до очереди, без обращения к модели
+        if SILENCE_RMS_THRESHOLD > 0 and await run_in_threadpool(is_silent, audio):
+            logger.info("Файл %s распознан как тишина", audio_file.filename)
+            if response_format == 'ndjson':
+                return Response(content=b"", media_type="application/x-ndjson")
+            result = {"text": "", "segments": [], "language": whisper_params.get("language")}
+        elif response_format == 'ndjson':
+            return StreamingResponse(stream_transcription(audio, whisper_params), media_type="application/x-ndjson")
+        else:
+            result = await submit_transcription(audio, whisper_params)
 
         # Возвращаем результат в нужном формате
         if response_format == 'text':
             return PlainTextResponse(content=result['text'])
         elif response_format == 'simple':
-            return {"text": result['text']}
+            return json_response({"text": result['text']})
         else:  # json - полный ответ по умолчанию
-            return result
+            return json_response(result)
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Ошибка транскрибации: {e}")
-        # Удаляем временный файл в случае ошибки
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.unlink(temp_file_path)
+        logger.error("Ошибка транскрибации: %s", e)
         raise HTTPException(status_code=500, detail=f"Ошибка транскрибации: {str(e)}")
 
 @app.post("/keys/reload")
 async def reload_keys(api_key: str = Depends(verify_api_key)):
     """Перезагружает ключи из файла"""
-    load_api_keys()
-    with keys_lock:
-        return {"message": f"Перезагружено {len(api_keys)} ключей"}
+    await run_in_threadpool(load_api_keys)
+    return {"message": f"Перезагружено {len(api_keys)} ключей"}
 
 @app.get("/keys/count")
 async def get_keys_count(api_key: str = Depends(verify_api_key)):
     """Возвращает количество активных ключей"""
-    with keys_lock:
-        return {"count": len(api_keys)}
+    return {"count": len(get_api_keys())}
 
 if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "9854"))
     log_level = os.getenv("LOG_LEVEL", "info")
+    # Каждый процесс загружает свою копию модели, поэтому по умолчанию процесс один
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
 
+    # uvloop и httptools ставятся с uvicorn[standard]; без них uvicorn откатится на asyncio и h11
     uvicorn.run(
         "app:app",
         host=host,
         port=port,
+        workers=workers,
+        loop="auto",
+        http="auto",
         log_level=log_level,
         reload=False
     )
@@ -9,16 +9,6 @@ set -e
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 APP_DIR="${SCRIPT_DIR}"
 
-# Set ROCm environment variables if ROCm is available
-if [ -d "/opt/rocm" ]; then
-    export ROCM_PATH=${ROCM_PATH:-"/opt/rocm"}
-    export PATH="${ROCM_PATH}/bin:${PATH}"
-    export LD_LIBRARY_PATH="${ROCM_PATH}/lib:${LD_LIBRARY_PATH:-}"
-    # Set HIP_VISIBLE_DEVICES to use all available GPUs
-    export HIP_VISIBLE_DEVICES=${HIP_VISIBLE_DEVICES:-"0"}
-    echo "ROCm detected, configured environment variables"
-fi
-
 # Function to generate a secure API key
 generate_api_key() {
     if command -v openssl >/dev/null 2>&1; then
@@ -43,7 +33,7 @@ fi
 export HOST=${HOST:-"0.0.0.0"}
 export PORT=${PORT:-9854}
 export DEFAULT_MODEL=${DEFAULT_MODEL:-"turbo"}
-export MODEL_DEVICE=${MODEL_DEVICE:-"cuda"}
+export MODEL_DEVICE=${MODEL_DEVICE:-"auto"}
 export MODEL_DOWNLOAD_ROOT=${MODEL_DOWNLOAD_ROOT:-"${APP_DIR}/models"}
 export KEYS_FILE=${KEYS_FILE:-"${APP_DIR}/data/keys.txt"}
 export LOG_LEVEL=${LOG_LEVEL:-"info"}